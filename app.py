@@ -1,5 +1,11 @@
 import streamlit as st
+import glob
+import hashlib
+import os
+import tempfile
 import pandas as pd
+import pyarrow as pa
+import numpy as np
 import plotly.express as px
 from io import BytesIO
 
@@ -7,6 +13,26 @@ from io import BytesIO
 # CONFIG
 # ----------------------------
 DATA_FILE = "Data Set_11.xlsx"
+CACHE_DIR = ".cache"
+# Bump whenever prepare_data changes so stale parquet files are ignored
+CACHE_VERSION = 10
+# Above this many rows the Insights scatter plots a random sample
+SCATTER_MAX_POINTS = 20000
+# Rows shown in the "View filtered data" preview
+PREVIEW_ROWS = 1000
+# Distinct filter selections kept by each per-selection cache
+CACHE_MAX_ENTRIES = 32
+
+CATEGORICAL_COLUMNS = [
+    "Region", "Segment", "Category", "Sub-Category", "Product Name",
+    "Order ID", "Customer ID"
+]
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
 
 st.set_page_config(
     page_title="Executive Dashboard (Data Set_11)",
@@ -18,18 +44,22 @@ st.set_page_config(
 # ----------------------------
 # DATA LOADING + PREPROCESSING
 # ----------------------------
-@st.cache_data
-def load_and_prepare(filepath: str) -> pd.DataFrame:
-    df = pd.read_excel(filepath)
+def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
     df.columns = [c.strip() for c in df.columns]
 
     if "InvoiceDate" in df.columns:
         df["InvoiceDate"] = pd.to_datetime(df["InvoiceDate"], errors="coerce")
 
+    # Columns the reader already typed as numeric need no coercion pass
     for c in ["Quantity", "UnitPrice", "CustomerID"]:
-        if c in df.columns:
+        if c in df.columns and df[c].dtype == object:
             df[c] = pd.to_numeric(df[c], errors="coerce")
 
+    # Codes mix ints and strings (e.g. "85014B"); keep them uniformly text
+    for c in ["InvoiceNo", "StockCode"]:
+        if c in df.columns:
+            df[c] = df[c].astype(str)
+
     df["Order ID"] = df.get("InvoiceNo")
     df["Product Name"] = df.get("Description")
     df["Customer ID"] = df.get("CustomerID")
@@ -39,47 +69,114 @@ def load_and_prepare(filepath: str) -> pd.DataFrame:
     df["Sub-Category"] = df.get("StockCode")
     df["Order Date"] = df.get("InvoiceDate")
 
-    df["Sales"] = df["Quantity"].fillna(0) * df["UnitPrice"].fillna(0)
+    df[["Quantity", "UnitPrice"]] = df[["Quantity", "UnitPrice"]].fillna(0)
+    df.eval("Sales = Quantity * UnitPrice", inplace=True)
 
     margin_map = {"Retail": 0.22, "B2B": 0.14}
-    df["Profit"] = df["Sales"] * df["Segment"].map(margin_map).fillna(0.18)
+    default_margin = 0.18
+    segment = df["Segment"].astype("category")
+    # Trailing default is what code -1 (missing segment) picks up
+    margin_by_code = np.array(
+        [margin_map.get(c, default_margin) for c in segment.cat.categories]
+        + [default_margin]
+    )
+    margin = margin_by_code[segment.cat.codes.to_numpy()]
+    df.eval("Profit = Sales * @margin", inplace=True)
 
     df["Discount"] = 0.0
-    df["Year"] = df["Order Date"].dt.year
-    df["Month"] = df["Order Date"].dt.month
-    df["Quarter"] = df["Order Date"].dt.quarter
-    df["Year-Month"] = df["Order Date"].dt.to_period("M").astype(str)
-
-    df["Profit Margin"] = df.apply(
-        lambda r: (r["Profit"] / r["Sales"]) * 100 if r["Sales"] != 0 else 0,
-        axis=1
-    )
+    # NaT rows get junk values here but are dropped below
+    dates = df["Order Date"].to_numpy("datetime64[ns]")
+    months = dates.astype("datetime64[M]").astype(np.int64)
+    year = months // 12 + 1970
+    month = months % 12 + 1
+    df["Year"] = year
+    df["Month"] = month
+    df["Quarter"] = (month - 1) // 3 + 1
 
     df = df.dropna(subset=["Order Date"])
     df["Customer ID"] = df["Customer ID"].fillna(-1).astype(int)
 
+    # Money columns stay float64 so exports and totals show exact cents
+    df["Quantity"] = df["Quantity"].astype("int32")
+    df["Discount"] = df["Discount"].astype("float32")
+    for c in ["Year", "Month", "Quarter"]:
+        df[c] = df[c].astype("int16")
+
+    for c in CATEGORICAL_COLUMNS:
+        df[c] = df[c].astype("category")
+
     return df
 
 
+@st.cache_data
+def load_and_prepare(filepath: str) -> tuple[pd.DataFrame, dict]:
+    with open(filepath, "rb") as f:
+        digest = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    cache_path = os.path.join(CACHE_DIR, f"{stem}-{digest}-v{CACHE_VERSION}.parquet")
+
+    df = None
+    if os.path.exists(cache_path):
+        try:
+            # Integer-valued categoricals (Customer ID) come back as plain ints
+            df = pd.read_parquet(cache_path).astype(
+                {c: "category" for c in CATEGORICAL_COLUMNS}
+            )
+        except (OSError, KeyError, ValueError, pa.ArrowException):
+            df = None
+
+    if df is None:
+        df = prepare_data(pd.read_excel(filepath, engine=EXCEL_ENGINE))
+        tmp_path = None
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # Write to a temp file first so readers never see a partial parquet
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            os.close(fd)
+            df.to_parquet(tmp_path, compression="zstd")
+            os.replace(tmp_path, cache_path)
+        except (OSError, ValueError, pa.ArrowException):
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        else:
+            # Drop files from older workbook contents or cache versions
+            pattern = f"{glob.escape(stem)}-{'[0-9a-f]' * 16}-v*.parquet"
+            for old_path in glob.glob(os.path.join(CACHE_DIR, pattern)):
+                if old_path != cache_path:
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        pass
+
+    # Lets downstream caches key on the data without hashing the frame
+    df.attrs["data_version"] = digest
+
+    options = {
+        "years": sorted(df["Year"].unique().tolist(), reverse=True),
+        "category": sorted(df["Category"].cat.categories.tolist()),
+        "region": sorted(df["Region"].cat.categories.tolist()),
+        "segment": sorted(df["Segment"].cat.categories.tolist())
+    }
+    return df, options
+
+
 def apply_filters(df: pd.DataFrame, filters: dict) -> pd.DataFrame:
-    out = df.copy()
+    mask = np.ones(len(df), dtype=bool)
 
     if filters["year"] != "All":
-        out = out[out["Year"] == filters["year"]]
+        mask &= df["Year"].to_numpy() == filters["year"]
 
-    out = out[
-        out["Category"].isin(filters["category"]) &
-        out["Region"].isin(filters["region"]) &
-        out["Segment"].isin(filters["segment"])
-    ]
+    mask &= df["Category"].isin(filters["category"]).to_numpy()
+    mask &= df["Region"].isin(filters["region"]).to_numpy()
+    mask &= df["Segment"].isin(filters["segment"]).to_numpy()
 
     start, end = filters["date_range"]
-    out = out[
-        (out["Order Date"] >= pd.to_datetime(start)) &
-        (out["Order Date"] <= pd.to_datetime(end))
-    ]
+    start64 = np.datetime64(pd.Timestamp(start), "ns")
+    end64 = np.datetime64(pd.Timestamp(end), "ns")
+    order_dates = df["Order Date"].to_numpy("datetime64[ns]")
+    mask &= (order_dates >= start64) & (order_dates <= end64)
 
-    return out
+    return df[mask]
 
 
 def calculate_kpis(df: pd.DataFrame) -> dict:
@@ -96,17 +193,51 @@ def calculate_kpis(df: pd.DataFrame) -> dict:
     }
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def calculate_kpis_cached(
+    _filtered_df: pd.DataFrame, data_version: str, filter_key: tuple
+) -> dict:
+    return calculate_kpis(_filtered_df)
+
+
+def aggregate_details(df: pd.DataFrame, groupby: str) -> pd.DataFrame:
+    gb = df.groupby(groupby, observed=True)
+    grouped = (
+        gb[["Sales", "Profit", "Quantity"]]
+        .sum()
+        .join(gb["Order ID"].count().rename("Orders"))
+        .sort_values("Sales", ascending=False)
+    )
+
+    grouped["Profit Margin %"] = grouped["Profit"] / grouped["Sales"] * 100
+    return grouped.fillna(0)
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def aggregate_details_cached(
+    _filtered_df: pd.DataFrame, data_version: str, filter_key: tuple, groupby: str
+) -> pd.DataFrame:
+    return aggregate_details(_filtered_df, groupby)
+
+
 def to_excel_bytes(df: pd.DataFrame) -> bytes:
     buffer = BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
         df.to_excel(writer, index=False)
     return buffer.getvalue()
 
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def to_csv_bytes_cached(
+    _filtered_df: pd.DataFrame, data_version: str, filter_key: tuple
+) -> bytes:
+    return _filtered_df.to_csv(index=False).encode()
+
+
 # ----------------------------
 # LOAD DATA
 # ----------------------------
-df = load_and_prepare(DATA_FILE)
+df, options = load_and_prepare(DATA_FILE)
 
 # ----------------------------
 # SIDEBAR
@@ -120,23 +251,22 @@ page = st.sidebar.radio(
 st.sidebar.markdown("---")
 st.sidebar.header("Filters")
 
-years = ["All"] + sorted(df["Year"].dropna().unique().tolist(), reverse=True)
 filters = {
-    "year": st.sidebar.selectbox("Year", years),
+    "year": st.sidebar.selectbox("Year", ["All"] + options["years"]),
     "category": st.sidebar.multiselect(
         "Category",
-        sorted(df["Category"].unique()),
-        default=sorted(df["Category"].unique())
+        options["category"],
+        default=options["category"]
     ),
     "region": st.sidebar.multiselect(
         "Region",
-        sorted(df["Region"].unique()),
-        default=sorted(df["Region"].unique())
+        options["region"],
+        default=options["region"]
     ),
     "segment": st.sidebar.multiselect(
         "Segment",
-        sorted(df["Segment"].unique()),
-        default=sorted(df["Segment"].unique())
+        options["segment"],
+        default=options["segment"]
     ),
     "date_range": st.sidebar.date_input(
         "Date Range",
@@ -144,6 +274,14 @@ filters = {
     )
 }
 
+data_version = df.attrs["data_version"]
+filter_key = (
+    filters["year"],
+    tuple(filters["category"]),
+    tuple(filters["region"]),
+    tuple(filters["segment"]),
+    tuple(filters["date_range"])
+)
 filtered_df = apply_filters(df, filters)
 
 # ----------------------------
@@ -153,7 +291,7 @@ st.title("Executive Dashboard")
 st.caption(f"Rows displayed: {len(filtered_df):,}")
 st.markdown("---")
 
-kpis = calculate_kpis(filtered_df)
+kpis = calculate_kpis_cached(filtered_df, data_version, filter_key)
 
 c1, c2, c3, c4, c5 = st.columns(5)
 c1.metric("Total Sales", f"${kpis['total_sales']:,.0f}")
@@ -171,20 +309,25 @@ if page == "Overview":
     col1, col2 = st.columns(2)
 
     with col1:
-        monthly = filtered_df.groupby("Year-Month")["Sales"].sum().reset_index()
-        fig = px.line(monthly, x="Year-Month", y="Sales", markers=True)
+        monthly = (
+            filtered_df.set_index("Order Date")["Sales"]
+            .resample("MS")
+            .sum()
+            .rename_axis("Month")
+            .reset_index()
+        )
+        fig = px.line(monthly, x="Month", y="Sales", markers=True)
         st.plotly_chart(fig, use_container_width=True)
 
     with col2:
-        mix = filtered_df.groupby("Segment")["Sales"].sum().reset_index()
+        mix = filtered_df.groupby("Segment", observed=True)["Sales"].sum().reset_index()
         fig = px.pie(mix, values="Sales", names="Segment", hole=0.4)
         st.plotly_chart(fig, use_container_width=True)
 
-    pivot = filtered_df.pivot_table(
-        values="Sales",
-        index="Segment",
-        columns="Region",
-        aggfunc="sum"
+    pivot = (
+        filtered_df.groupby(["Segment", "Region"], observed=True)["Sales"]
+        .sum()
+        .unstack("Region", fill_value=0)
     )
     fig = px.imshow(pivot, text_auto=".2s")
     st.plotly_chart(fig, use_container_width=True)
@@ -198,19 +341,7 @@ elif page == "Details":
         ["Product Name", "Sub-Category", "Region", "Segment", "Customer ID"]
     )
 
-    grouped = (
-        filtered_df.groupby(groupby)
-        .agg(
-            Sales=("Sales", "sum"),
-            Profit=("Profit", "sum"),
-            Quantity=("Quantity", "sum"),
-            Orders=("Order ID", "count")
-        )
-        .sort_values("Sales", ascending=False)
-    )
-
-    grouped["Profit Margin %"] = grouped["Profit"] / grouped["Sales"] * 100
-    grouped = grouped.fillna(0)
+    grouped = aggregate_details_cached(filtered_df, data_version, filter_key, groupby)
 
     st.dataframe(
         grouped.style.format({
@@ -233,19 +364,31 @@ elif page == "Details":
 # INSIGHTS
 # ----------------------------
 elif page == "Insights":
+    scatter_df = filtered_df
+    if len(scatter_df) > SCATTER_MAX_POINTS:
+        scatter_df = scatter_df.sample(SCATTER_MAX_POINTS, random_state=0)
+        st.caption(f"Scatter shows a sample of {SCATTER_MAX_POINTS:,} rows")
+
     fig = px.scatter(
-        filtered_df,
+        scatter_df,
         x="UnitPrice",
         y="Quantity",
         size="Sales",
         color="Segment",
-        hover_data=["Product Name", "Region"]
+        hover_data=["Product Name", "Region"],
+        render_mode="webgl"
     )
+    fig.update_layout(hovermode="closest")
     st.plotly_chart(fig, use_container_width=True)
 
-    corr = filtered_df[
-        ["Sales", "Profit", "Quantity", "UnitPrice", "Profit Margin"]
-    ].corr(numeric_only=True)
+    sales = filtered_df["Sales"].to_numpy(dtype=float)
+    profit = filtered_df["Profit"].to_numpy(dtype=float)
+    margin = np.divide(profit, sales, out=np.zeros_like(sales), where=sales != 0) * 100
+    corr = (
+        filtered_df[["Sales", "Profit", "Quantity", "UnitPrice"]]
+        .assign(**{"Profit Margin": margin})
+        .corr(numeric_only=True)
+    )
 
     fig = px.imshow(corr, text_auto=".2f")
     st.plotly_chart(fig, use_container_width=True)
@@ -273,7 +416,17 @@ elif page == "What-If":
 # RAW DATA
 # ----------------------------
 with st.expander("View filtered data"):
-    st.dataframe(filtered_df, use_container_width=True)
+    if len(filtered_df) > PREVIEW_ROWS:
+        st.caption(f"Showing the first {PREVIEW_ROWS:,} of {len(filtered_df):,} rows")
+    st.dataframe(filtered_df.head(PREVIEW_ROWS), use_container_width=True)
+    # The expander body runs on every rerun, so only export when asked
+    if st.toggle("Prepare full download"):
+        st.download_button(
+            "Download full filtered data",
+            to_csv_bytes_cached(filtered_df, data_version, filter_key),
+            "filtered.csv",
+            mime="text/csv"
+        )
 
 st.markdown("---")
 st.caption("Built with Streamlit and Plotly")